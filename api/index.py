@@ -1,16 +1,43 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import logging
+import time
+import asyncio
+import base64
+import hmac
 import re
-import json
-import requests
+import orjson
+import httpx
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import NamedTuple
+from urllib.parse import urlsplit, parse_qs
 from upstash_redis.asyncio import Redis
-from pikpakapi import PikPakApi
+from pikpakapi import PikPakApi, PikpakException
+
+# -----------------------
+# Logging
+# -----------------------
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper())
+log = logging.getLogger(__name__)
 
 # -----------------------
 # App
 # -----------------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the client and file index while the first probes are served.
+    warm_up()
+    yield
+    # Shared clients are created at import; close them on shutdown.
+    await _http.aclose()
+    await redis.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,9 +50,64 @@ app.add_middleware(
 # -----------------------
 # Constants
 # -----------------------
+PIKPAK_PREFIX = "pikpak:"
+POSTER = "https://upload.wikimedia.org/wikipedia/commons/8/8c/PikPak_logo.png"
 VIDEO_EXT = (".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv", ".ts")
+_VIDEO_EXT_SET = frozenset(ext[1:] for ext in VIDEO_EXT)
 SESSION_TTL = 60 * 60 * 24 * 365   # 1 year
-URL_CACHE_TTL = 60 * 60 * 24       # 24h
+TOKEN_REFRESH_MARGIN = 60 * 5      # refresh access tokens this early
+URL_CACHE_TTL = 60 * 60 * 4        # 4h, when the URL carries no expiry
+URL_EXPIRY_MARGIN = 60 * 5         # stop serving a URL 5 min before it dies
+URL_MEMORY_TTL = 60 * 5            # in-process copy of the URL cache
+URL_MEMORY_SIZE = 512              # max in-process URL entries (LRU)
+MOVIE_INFO_TTL = 60 * 60 * 24      # 24h
+MOVIE_INFO_MEMORY_TTL = 60 * 10    # in-process copy of the Cinemeta cache
+MOVIE_INFO_MEMORY_SIZE = 256       # max in-process Cinemeta entries
+FILE_INDEX_SOFT_TTL = 60 * 5       # 5 min, then refreshed in background
+FILE_INDEX_TTL = 60 * 60 * 24      # 24h, hard expiry of the stale copy
+CATALOG_MAX_AGE = 60 * 5           # client / CDN cache for catalog
+CATALOG_STALE_TTL = 60 * 60        # CDN may serve a stale catalog this long
+MANIFEST_MAX_AGE = 60 * 60 * 24    # client / CDN cache for manifest
+FILE_INDEX_KEY = "pikpak:index:v6"  # bump when the record shape changes
+FILE_LIST_CONCURRENCY = 8          # parallel file_list calls
+DOWNLOAD_URL_CONCURRENCY = 4       # parallel get_download_url calls
+
+_NON_ALNUM = re.compile(r"[^a-z0-9 ]+")
+_STREAM_ID_RE = re.compile(
+    rf"{re.escape(PIKPAK_PREFIX)}(?P<file_id>.+)|(?P<imdb_id>tt\d+)"
+)
+_ASCII_TABLE = str.maketrans({
+    c: " " for c in map(chr, range(128))
+    if not ("a" <= c <= "z" or "0" <= c <= "9")
+})
+
+# -----------------------
+# File index (parallel columns, one row per video file)
+# -----------------------
+class FileIndex(NamedTuple):
+    ids: list
+    names: list
+    norms: list
+
+
+_haystack: tuple = (None, "")      # (index, newline-joined norms)
+
+
+def index_haystack(index: FileIndex) -> str:
+    # Built once per decoded index, not once per stream request.
+    global _haystack
+
+    if _haystack[0] is not index:
+        _haystack = (index, "\n".join(index.norms))
+    return _haystack[1]
+
+# -----------------------
+# HTTP client (shared, keep-alive)
+# -----------------------
+_http = httpx.AsyncClient(
+    timeout=10,
+    http2=True,
+)
 
 # -----------------------
 # Redis (ASYNC)
@@ -35,152 +117,648 @@ redis = Redis(
     token=os.environ["UPSTASH_REDIS_REST_TOKEN"],
 )
 
+# -----------------------
+# In-process URL cache (LRU in front of Redis)
+# -----------------------
+_url_memory: OrderedDict = OrderedDict()   # file_id -> (url, expires_at)
+
+
+def memory_get_url(file_id: str):
+    hit = _url_memory.get(file_id)
+    if not hit:
+        return None
+
+    url, expires_at = hit
+    if expires_at <= time.monotonic():
+        del _url_memory[file_id]
+        return None
+
+    _url_memory.move_to_end(file_id)
+    return url
+
+
+def memory_set_url(file_id: str, url: str):
+    ttl = min(URL_MEMORY_TTL, url_ttl(url))
+    _url_memory[file_id] = (url, time.monotonic() + ttl)
+    _url_memory.move_to_end(file_id)
+
+    while len(_url_memory) > URL_MEMORY_SIZE:
+        _url_memory.popitem(last=False)
+
+# -----------------------
+# In-process Cinemeta cache and in-flight lookups
+# -----------------------
+_movie_info_memory: dict = {}      # imdb_id -> ((title, year), expires_at)
+_movie_info_inflight: dict = {}    # imdb_id -> asyncio.Task
+
 # -----------------------
 # Redis helpers
 # -----------------------
+# Also the client's token_refresh_callback, so every refresh the library
+# does on its own is persisted; a failed write must not fail the refresh.
 async def save_session(client: PikPakApi):
     data = client.to_dict()
-    await redis.set(
-        "pikpak:session",
-        json.dumps(data),
-        ex=SESSION_TTL,
-    )
-    print("✅ Session saved to Redis")
+    try:
+        await redis.set(
+            "pikpak:session",
+            orjson.dumps(data).decode(),
+            ex=SESSION_TTL,
+        )
+    except Exception as e:
+        log.warning("⚠️ Session save failed: %s", e)
+        return
+    log.debug("✅ Session saved to Redis")
 
 
 async def load_session():
     raw = await redis.get("pikpak:session")
     if not raw:
-        print("ℹ️ No session in Redis")
+        log.info("ℹ️ No session in Redis")
         return None
-    print("✅ Session loaded from Redis")
-    return PikPakApi.from_dict(json.loads(raw))
+    log.debug("✅ Session loaded from Redis")
+    restored = PikPakClient.from_dict(orjson.loads(raw))
+    # to_dict drops callables, so the refresh callback is set again.
+    restored.token_refresh_callback = save_session
+    return restored
+
+
+def url_ttl(url: str) -> int:
+    query = parse_qs(urlsplit(url).query)
+    for key in ("expire", "expires", "Expires", "e"):
+        value = query.get(key, [""])[0]
+        if value.isdigit():
+            return max(60, int(value) - int(time.time()) - URL_EXPIRY_MARGIN)
+    return URL_CACHE_TTL
 
 
 async def get_cached_url(file_id: str):
-    return await redis.get(f"pikpak:url:{file_id}")
+    url = memory_get_url(file_id)
+    if url:
+        return url
+
+    url = await redis.get(f"pikpak:url:{file_id}")
+    if url:
+        memory_set_url(file_id, url)
+    return url
 
 
+# URLs are only written after a cache miss, so SET NX lets the first of
+# several racing requests win instead of each overwriting the key.
+# Redis only; callers fill the in-process copy before spawning these.
 async def set_cached_url(file_id: str, url: str):
-    await redis.set(f"pikpak:url:{file_id}", url, ex=URL_CACHE_TTL)
+    try:
+        await redis.set(
+            f"pikpak:url:{file_id}", url, ex=url_ttl(url), nx=True
+        )
+    except Exception as e:
+        log.warning("⚠️ URL cache write failed: %s", e)
+
+
+async def get_cached_urls(file_ids: list) -> list:
+    urls = [memory_get_url(fid) for fid in file_ids]
+    missing = [fid for fid, url in zip(file_ids, urls) if not url]
+    if not missing:
+        return urls
+
+    fetched = dict(zip(
+        missing,
+        await redis.mget(*(f"pikpak:url:{fid}" for fid in missing)),
+    ))
+    for fid, url in fetched.items():
+        if url:
+            memory_set_url(fid, url)
+
+    return [url or fetched[fid] for fid, url in zip(file_ids, urls)]
+
+
+async def set_cached_urls(urls: dict):
+    if not urls:
+        return
+    pipe = redis.pipeline()
+    for file_id, url in urls.items():
+        pipe.set(f"pikpak:url:{file_id}", url, ex=url_ttl(url), nx=True)
+
+    # The URLs are already resolved; a failed write must not fail the
+    # stream response.
+    try:
+        await pipe.exec()
+    except Exception as e:
+        log.warning("⚠️ URL cache write failed: %s", e)
+
+
+async def load_file_index():
+    raw = await redis.get(FILE_INDEX_KEY)
+    if not raw:
+        return None
+    data = orjson.loads(raw)
+    return data["generated_at"], FileIndex(data["ids"], data["names"], data["norms"])
+
+
+async def save_file_index(generated_at: float, index: FileIndex):
+    # Columns are stored as three flat string arrays.
+    payload = {"generated_at": generated_at, **index._asdict()}
+
+    # The index is already built and kept in memory; a failed write must
+    # not fail the request that rebuilt it.
+    try:
+        await redis.set(
+            FILE_INDEX_KEY,
+            orjson.dumps(payload).decode(),
+            ex=FILE_INDEX_TTL,
+        )
+        # The encoded catalog was built from the previous index.
+        await redis.delete("pikpak:catalog")
+    except Exception as e:
+        log.warning("⚠️ File index cache write failed: %s", e)
+
+
+async def get_cached_catalog():
+    return await redis.get("pikpak:catalog")
+
+
+async def set_cached_catalog(body: str):
+    # The catalog is already built; a failed write must not fail it.
+    try:
+        await redis.set("pikpak:catalog", body, ex=CATALOG_MAX_AGE)
+    except Exception as e:
+        log.warning("⚠️ Catalog cache write failed: %s", e)
+
+
+async def get_cached_movie_info(imdb_id: str):
+    raw = await redis.get(f"pikpak:imdb:{imdb_id}")
+    if not raw:
+        return None
+    return tuple(orjson.loads(raw))
+
+
+async def set_cached_movie_info(imdb_id: str, info: tuple):
+    # Cinemeta already answered; a failed write must not fail the stream.
+    try:
+        await redis.set(
+            f"pikpak:imdb:{imdb_id}",
+            orjson.dumps(info).decode(),
+            ex=MOVIE_INFO_TTL,
+        )
+    except Exception as e:
+        log.warning("⚠️ Movie info cache write failed: %s", e)
 
 # -----------------------
 # Utils
 # -----------------------
+@lru_cache(maxsize=8192)
 def normalize(text: str) -> str:
     text = text.lower()
-    text = re.sub(r"[^a-z0-9 ]", " ", text)
-    return re.sub(r"\s+", " ", text).strip()
+    if text.isascii():
+        text = text.translate(_ASCII_TABLE)
+    else:
+        text = _NON_ALNUM.sub(" ", text)
+    return " ".join(text.split())
+
+
+def log_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        log.warning("⚠️ Background task failed: %s", task.exception())
+
+
+_background: set[asyncio.Task] = set()   # strong refs until tasks finish
 
 
-def get_movie_info(imdb_id: str):
-    url = f"https://v3-cinemeta.strem.io/meta/movie/{imdb_id}.json"
-    r = requests.get(url, timeout=10)
-    meta = r.json().get("meta", {})
-    return meta.get("name", ""), str(meta.get("year", ""))
+def spawn(coro) -> asyncio.Task:
+    # Task that may never be awaited; the loop only holds a weak reference,
+    # so it is kept alive here and its failure is logged, not lost.
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    task.add_done_callback(log_task_error)
+    return task
+
+
+def is_video(name: str) -> bool:
+    # Only the short extension is lower-cased, not the whole filename.
+    _, dot, ext = name.rpartition(".")
+    return bool(dot) and ext.lower() in _VIDEO_EXT_SET
+
+
+def cache_control(max_age: int, stale: int = 0) -> dict:
+    value = f"public, max-age={max_age}, s-maxage={max_age}"
+    if stale:
+        value += f", stale-while-revalidate={stale}"
+    return {"Cache-Control": value}
+
+
+def json_response(content: dict, headers: dict | None = None) -> Response:
+    # Encoded with orjson directly; FastAPI's ORJSONResponse is deprecated.
+    return Response(
+        orjson.dumps(content),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+def cached_json(content: dict, max_age: int):
+    return json_response(content, cache_control(max_age))
+
+
+def match_files(haystack: str, title_n: str, year: str) -> list:
+    # Scan every normalized name in one C-level pass over the newline-joined
+    # haystack; Python only runs per hit, not per file. Returns row numbers.
+    # An empty title would match every row, so it matches none.
+    if not haystack or not title_n:
+        return []
+
+    matches = []
+    line, line_start = 0, 0
+
+    pos = haystack.find(title_n)
+    while pos != -1:
+        start = haystack.rfind("\n", 0, pos) + 1
+        end = haystack.find("\n", pos)
+        if end == -1:
+            end = len(haystack)
+
+        line += haystack.count("\n", line_start, start)
+        line_start = start
+
+        if not year or year in haystack[start:end]:
+            matches.append(line)
+
+        pos = haystack.find(title_n, end + 1)
+
+    return matches
+
+
+async def fetch_movie_info(imdb_id: str):
+    cached = await get_cached_movie_info(imdb_id)
+    if not cached:
+        url = f"https://v3-cinemeta.strem.io/meta/movie/{imdb_id}.json"
+        r = await _http.get(url)
+        meta = orjson.loads(r.content).get("meta", {})
+        info = meta.get("name", ""), str(meta.get("year", ""))
+
+        if not info[0]:
+            return info
+        await set_cached_movie_info(imdb_id, info)
+        cached = info
+
+    _movie_info_memory[imdb_id] = (cached, time.monotonic() + MOVIE_INFO_MEMORY_TTL)
+    while len(_movie_info_memory) > MOVIE_INFO_MEMORY_SIZE:
+        del _movie_info_memory[next(iter(_movie_info_memory))]
+    return cached
+
+
+async def get_movie_info(imdb_id: str):
+    hit = _movie_info_memory.get(imdb_id)
+    if hit and hit[1] > time.monotonic():
+        return hit[0]
+
+    # Concurrent requests for the same id share one Redis/Cinemeta lookup.
+    task = _movie_info_inflight.get(imdb_id)
+    if task is None:
+        task = asyncio.create_task(fetch_movie_info(imdb_id))
+        _movie_info_inflight[imdb_id] = task
+        task.add_done_callback(lambda _: _movie_info_inflight.pop(imdb_id, None))
+    return await asyncio.shield(task)
 
 # -----------------------
 # PikPak client manager
 # -----------------------
 client: PikPakApi | None = None
+_client_lock = asyncio.Lock()
+
+
+class PikPakClient(PikPakApi):
+    # Records whether the last token refresh failed. The library refreshes
+    # on its own when a call hits error_code 16, and a failure there is the
+    # sign of a dead session (revoked, or logged out elsewhere) whatever
+    # the token's exp says.
+    refresh_failed = False
+
+    async def refresh_access_token(self) -> None:
+        # Cleared first so the session saved by the callback is clean.
+        self.refresh_failed = False
+        try:
+            await super().refresh_access_token()
+        except Exception:
+            self.refresh_failed = True
+            raise
+
+
+def token_expires_at(pk: PikPakApi) -> float:
+    # PikPak access tokens are JWTs; "exp" is read without verification.
+    # A token that can't be parsed is left to the library to refresh.
+    if not pk.access_token:
+        return 0.0
+    try:
+        payload = pk.access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(orjson.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return float("inf")
 
 
-async def get_client(force_login=False):
-    global client
-
-    if client and not force_login:
-        return client
+def token_fresh(pk: PikPakApi) -> bool:
+    return time.time() < token_expires_at(pk) - TOKEN_REFRESH_MARGIN
 
-    # -----------------------
-    # Try restore session
-    # -----------------------
-    if not force_login:
-        restored = await load_session()
-        if restored:
-            try:
-                await restored.refresh_access_token()
-                client = restored
-                await save_session(client)
-                print("✅ PikPak session restored")
-                return client
-            except Exception as e:
-                print("⚠️ Session restore failed:", e)
 
-    # -----------------------
-    # Full login
-    # -----------------------
-    client = PikPakApi(
+async def login() -> PikPakApi:
+    pk = PikPakClient(
         username=os.environ["PIKPAK_EMAIL"],
         password=os.environ["PIKPAK_PASSWORD"],
+        token_refresh_callback=save_session,
     )
 
-    await client.login()
-    await client.refresh_access_token()
-    await save_session(client)
+    # The refresh callback saves the new session.
+    await pk.login()
+    await pk.refresh_access_token()
+
+    log.info("🔐 Full login completed")
+    return pk
+
+
+def client_usable(stale_token: str | None) -> bool:
+    return bool(client) and token_fresh(client) and client.access_token != stale_token
 
-    print("🔐 Full login completed")
-    return client
+
+async def get_client(stale_token: str | None = None) -> PikPakApi:
+    # stale_token is an access token a caller saw fail; if it is still the
+    # current one, the session is refreshed or replaced.
+    global client
+
+    if client_usable(stale_token):
+        return client
+
+    # Setup, refreshes and recovery all run under the lock, ahead of
+    # expiry, so a burst of requests shares one refresh or login instead
+    # of each hitting error_code 16 and refreshing the shared client.
+    async with _client_lock:
+        if client_usable(stale_token):
+            return client
+
+        # -----------------------
+        # Refresh or restore session
+        # -----------------------
+        pk = client or await load_session()
+        if pk:
+            # A still-valid access token is used without a network call;
+            # otherwise refresh, and log in again if that fails.
+            try:
+                if not token_fresh(pk) or pk.access_token == stale_token:
+                    await pk.refresh_access_token()
+                    log.info("🔄 PikPak token refreshed")
+                client = pk
+                return client
+            except Exception as e:
+                log.warning("⚠️ Token refresh failed: %s", e)
+
+        # -----------------------
+        # Full login
+        # -----------------------
+        # Assigned only once login finishes so the lock-free fast path
+        # never sees a half-initialised client. The new session replaces
+        # the dead one in Redis through the refresh callback.
+        client = await login()
+        return client
 
 
 async def with_relogin(fn, *args, **kwargs):
+    pk = fn.__self__
+    token = pk.access_token
+
     try:
         return await fn(*args, **kwargs)
-    except Exception as e:
-        if "401" in str(e).lower():
-            await get_client(force_login=True)
-            return await fn(*args, **kwargs)
-        raise
+    except PikpakException:
+        # A failed library refresh or an expired token means the session
+        # is dead; anything else is an ordinary API error.
+        if token_fresh(pk) and not getattr(pk, "refresh_failed", False):
+            raise
+        pk = await get_client(token)
+        fn = getattr(pk, fn.__name__)
+        return await fn(*args, **kwargs)
+
+# -----------------------
+# File traversal (breadth-first, parallel per level)
+# -----------------------
+async def list_folder(pk, parent_id: str, sem):
+    async with sem:
+        return await with_relogin(pk.file_list, parent_id=parent_id)
+
+
+async def collect_files(pk, root=""):
+    sem = asyncio.BoundedSemaphore(FILE_LIST_CONCURRENCY)
+    files = []
+    frontier = [root]
+
+    while frontier:
+        pages = await asyncio.gather(
+            *(list_folder(pk, parent_id, sem) for parent_id in frontier)
+        )
+
+        frontier = []
+        for data in pages:
+            for f in data.get("files", []):
+                if f.get("kind") == "drive#folder":
+                    frontier.append(f["id"])
+                else:
+                    files.append(f)
+
+    return files
+
+
+_index_refresh: asyncio.Task | None = None
+_index_memory: tuple | None = None     # (generated_at, index) decoded copy
+
+
+async def build_file_index():
+    global _index_memory
+
+    pk = await get_client()
+    files = await collect_files(pk)
+    index = FileIndex([], [], [])
+    for f in files:
+        name = f.get("name")
+        if not name or not f.get("id"):
+            continue
+
+        if not is_video(name):
+            continue
+
+        index.ids.append(f["id"])
+        index.names.append(name)
+        index.norms.append(normalize(name))
+
+    generated_at = time.time()
+    _index_memory = (generated_at, index)
+    await save_file_index(generated_at, index)
+    log.info("📂 File index rebuilt (%d files)", len(index.ids))
+    return index
+
+
+def refresh_file_index() -> asyncio.Task:
+    global _index_refresh
+
+    # At most one rebuild in flight per instance; callers share it.
+    if _index_refresh is None or _index_refresh.done():
+        _index_refresh = spawn(build_file_index())
+    return _index_refresh
+
+
+async def get_file_index():
+    global _index_memory
+
+    # A fresh decoded copy in this instance skips Redis and decoding.
+    if _index_memory and time.time() - _index_memory[0] <= FILE_INDEX_SOFT_TTL:
+        return _index_memory[1]
+
+    cached = await load_file_index()
+    if cached is None:
+        # Shielded so a cancelled request doesn't cancel the shared rebuild.
+        return await asyncio.shield(refresh_file_index())
+
+    # Stale-while-revalidate: serve the cached copy right away and
+    # rebuild it off the request path once it is past the soft TTL.
+    _index_memory = cached
+    generated_at, index = cached
+    if time.time() - generated_at > FILE_INDEX_SOFT_TTL:
+        refresh_file_index()
+    return index
+
+
+_warm_task: asyncio.Task | None = None
+
+
+async def _warm():
+    await get_client()
+    await get_file_index()
+
+
+def warm_up() -> asyncio.Task:
+    global _warm_task
+
+    # Runs once per instance; later calls return the same task.
+    if _warm_task is None:
+        _warm_task = spawn(_warm())
+    return _warm_task
 
 # -----------------------
-# Recursive file traversal
+# Download URL resolution
 # -----------------------
-async def collect_files(pk, parent_id="", result=None):
-    if result is None:
-        result = []
+def extract_url(data: dict):
+    links = data.get("links", {})
+    if "application/octet-stream" in links:
+        return links["application/octet-stream"]["url"]
+
+    medias = data.get("medias", [])
+    if medias:
+        return medias[0]["link"]["url"]
+
+    return None
+
+
+async def fetch_url(pk, file_id: str, sem):
+    async with sem:
+        data = await with_relogin(pk.get_download_url, file_id)
+    return extract_url(data)
+
+
+async def resolve_url(file_id: str, client_task: asyncio.Task | None = None):
+    url = await get_cached_url(file_id)
+    if url:
+        return url
+
+    pk = await (client_task or get_client())
+    url = extract_url(await with_relogin(pk.get_download_url, file_id))
+    if url:
+        # The in-process copy is filled synchronously; Upstash is written
+        # behind the response.
+        memory_set_url(file_id, url)
+        spawn(set_cached_url(file_id, url))
+    return url
+
+
+async def resolve_urls(file_ids: list, client_task: asyncio.Task | None = None) -> list:
+    cached = await get_cached_urls(file_ids)
+    missing = [fid for fid, url in zip(file_ids, cached) if not url]
+    if not missing:
+        return cached
+
+    pk = await (client_task or get_client())
+    sem = asyncio.Semaphore(DOWNLOAD_URL_CONCURRENCY)
+    fetched = await asyncio.gather(
+        *(fetch_url(pk, fid, sem) for fid in missing),
+        return_exceptions=True,
+    )
 
-    data = await with_relogin(pk.file_list, parent_id=parent_id)
-    for f in data.get("files", []):
-        if f.get("kind") == "drive#folder":
-            await collect_files(pk, f["id"], result)
-        else:
-            result.append(f)
+    fresh = {}
+    for fid, url in zip(missing, fetched):
+        if isinstance(url, Exception):
+            log.warning("⚠️ Download URL failed for %s: %s", fid, url)
+        elif url:
+            fresh[fid] = url
+    if fresh:
+        for fid, url in fresh.items():
+            memory_set_url(fid, url)
+        spawn(set_cached_urls(fresh))
 
-    return result
+    return [url or fresh.get(fid) for fid, url in zip(file_ids, cached)]
 
 # -----------------------
 # Routes
 # -----------------------
 @app.get("/")
 async def root():
-    return {"status": "ok"}
+    return json_response({"status": "ok"})
 
 # -----------------------
 # Debug
 # -----------------------
 @app.get("/debug/session")
 async def debug_session():
-    return {
+    return json_response({
         "session_exists": bool(await redis.get("pikpak:session"))
-    }
+    })
+
+
+@app.post("/debug/refresh")
+async def debug_refresh(x_debug_token: str = Header("")):
+    global _index_memory
+
+    # Forces a full tree walk on the next request, so it needs a secret;
+    # without DEBUG_TOKEN set the endpoint is disabled.
+    secret = os.environ.get("DEBUG_TOKEN", "")
+    if not secret or not hmac.compare_digest(
+        x_debug_token.encode(), secret.encode()
+    ):
+        raise HTTPException(status_code=403)
+
+    _index_memory = None
+    await redis.delete(FILE_INDEX_KEY, "pikpak:catalog")
+    return json_response({"status": "ok"})
 
 # -----------------------
 # Manifest
 # -----------------------
+MANIFEST = orjson.dumps({
+    "id": "com.arun.pikpak",
+    "version": "2.0.0",
+    "name": "PikPak Cloud",
+    "types": ["movie"],
+    "resources": ["catalog", "stream"],
+    "catalogs": [{
+        "type": "movie",
+        "id": "pikpak",
+        "name": "My PikPak Files"
+    }],
+    "idPrefixes": ["tt", "pikpak"]
+})
+
+
 @app.get("/manifest.json")
 async def manifest():
-    return {
-        "id": "com.arun.pikpak",
-        "version": "2.0.0",
-        "name": "PikPak Cloud",
-        "types": ["movie"],
-        "resources": ["catalog", "stream"],
-        "catalogs": [{
-            "type": "movie",
-            "id": "pikpak",
-            "name": "My PikPak Files"
-        }],
-        "idPrefixes": ["tt", "pikpak"]
-    }
+    return Response(
+        MANIFEST,
+        media_type="application/json",
+        headers=cache_control(MANIFEST_MAX_AGE),
+    )
 
 # -----------------------
 # Catalog
@@ -188,113 +766,95 @@ async def manifest():
 @app.get("/catalog/{type}/{id}.json")
 async def catalog(type: str, id: str):
     if type != "movie" or id != "pikpak":
-        return {"metas": []}
+        return json_response({"metas": []})
 
-    pk = await get_client()
-    files = await collect_files(pk)
+    # The encoded response is cached as-is, so a hit skips decoding the
+    # file index and re-encoding the metas.
+    body = await get_cached_catalog()
+    if not body:
+        index = await get_file_index()
 
-    metas = []
-    for f in files:
-        name = f.get("name")
-        fid = f.get("id")
-        if name and fid and name.lower().endswith(VIDEO_EXT):
-            metas.append({
-                "id": f"pikpak:{fid}",
+        metas = [
+            {
+                "id": f"{PIKPAK_PREFIX}{file_id}",
                 "type": "movie",
                 "name": name,
-                "poster": "https://upload.wikimedia.org/wikipedia/commons/8/8c/PikPak_logo.png"
-            })
-
-    return {"metas": metas}
+                "poster": POSTER,
+            }
+            for file_id, name in zip(index.ids, index.names)
+        ]
+
+        body = orjson.dumps({"metas": metas}).decode()
+        await set_cached_catalog(body)
+
+    return Response(
+        body,
+        media_type="application/json",
+        headers=cache_control(CATALOG_MAX_AGE, CATALOG_STALE_TTL),
+    )
 
 # -----------------------
 # Stream
 # -----------------------
 @app.get("/stream/{type}/{id}.json")
 async def stream(type: str, id: str):
-
-    pk = await get_client()
+    m = _STREAM_ID_RE.fullmatch(id)
+    if not m:
+        return json_response({"streams": []})
 
     # -----------------------
     # 1️⃣ Direct PikPak ID
     # -----------------------
-    if id.startswith("pikpak:"):
-        file_id = id.replace("pikpak:", "")
+    if m["file_id"]:
+        file_id = m["file_id"]
 
-        url = await get_cached_url(file_id)
+        # A cached URL is the common case here, so the PikPak client is
+        # only set up on a cache miss.
+        url = await resolve_url(file_id)
         if not url:
-            data = await pk.get_download_url(file_id)
-
-            links = data.get("links", {})
-            if "application/octet-stream" in links:
-                url = links["application/octet-stream"]["url"]
-            else:
-                medias = data.get("medias", [])
-                if medias:
-                    url = medias[0]["link"]["url"]
-
-            if not url:
-                return {"streams": []}
-
-            await set_cached_url(file_id, url)
+            return json_response({"streams": []})
 
-        return {
+        return cached_json({
             "streams": [{
                 "name": "PikPak",
                 "title": "PikPak Direct",
                 "url": url
             }]
-        }
+        }, url_ttl(url))
 
     # -----------------------
     # 2️⃣ IMDb movie matching
     # -----------------------
     if type != "movie":
-        return {"streams": []}
-
-    movie_title, movie_year = get_movie_info(id)
+        return json_response({"streams": []})
+
+    # The client is set up speculatively while Cinemeta and the file
+    # index are read; it is only awaited if some match misses the cache.
+    client_task = spawn(get_client())
+    (movie_title, movie_year), index = await asyncio.gather(
+        get_movie_info(m["imdb_id"]),
+        get_file_index(),
+    )
     movie_n = normalize(movie_title)
+    if not movie_n:
+        return json_response({"streams": []})
+    matches = match_files(index_haystack(index), movie_n, movie_year)
 
-    files = await collect_files(pk)
-    streams = []
-
-    for f in files:
-        name = f.get("name")
-        file_id = f.get("id")
+    urls = await resolve_urls([index.ids[i] for i in matches], client_task)
 
-        if not name or not file_id:
-            continue
-        if not name.lower().endswith(VIDEO_EXT):
-            continue
-
-        file_n = normalize(name)
-
-        if movie_n not in file_n:
-            continue
-        if movie_year and movie_year not in file_n:
-            continue
-
-        url = await get_cached_url(file_id)
+    streams = []
+    for i, url in zip(matches, urls):
         if not url:
-            data = await pk.get_download_url(file_id)
-
-            links = data.get("links", {})
-            if "application/octet-stream" in links:
-                url = links["application/octet-stream"]["url"]
-            else:
-                medias = data.get("medias", [])
-                if medias:
-                    url = medias[0]["link"]["url"]
-
-            if not url:
-                continue
-
-            await set_cached_url(file_id, url)
-
+            continue
         streams.append({
             "name": "PikPak",
-            "title": name,
+            "title": index.names[i],
             "url": url
         })
 
-    return {"streams": streams}
+    if not streams:
+        return json_response({"streams": streams})
+    return cached_json(
+        {"streams": streams},
+        min(url_ttl(s["url"]) for s in streams),
+    )